@@ -1,86 +1,433 @@
 # evaluate_counting.py
 import cv2
 import json
+import multiprocessing
+import numpy as np
 import os
-from collections import defaultdict
-from src import SimpleAnimalDetector, load_config
+import queue
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from src import SimpleAnimalDetector, load_config, get_class_names
+
+# orjson is optional; the stdlib encoder is the fallback
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# numba is optional; without it the metric kernel runs as plain Python
+try:
+    from numba import njit
+except ImportError:
+    def njit(*args, **kwargs):
+        def decorator(func):
+            return func
+        return decorator
+
+# decord is optional; built with CUDA it decodes straight into GPU memory (NVDEC)
+try:
+    import decord
+except ImportError:
+    decord = None
+
+# Marks the end of a video's decoded frames
+_END_OF_STREAM = None
+
+
+def _sampled_frames(cap, stride, seek=False):
+    """Yield every ``stride``-th frame of ``cap``"""
+    total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    if seek and total_frames > 0:
+        yield from _seek_frames(cap, stride, total_frames)
+    else:
+        yield from _grab_frames(cap, stride)
+
+
+def _grab_frames(cap, stride):
+    """Walk the stream frame by frame, retrieving only sampled frames"""
+    frame_count = 0
+    
+    # grab() advances the stream without colour conversion;
+    # only sampled frames are retrieved
+    while cap.grab():
+        frame_index = frame_count
+        frame_count += 1
+        if frame_index % stride:
+            continue
+        
+        ret, frame = cap.retrieve()
+        if not ret:
+            break
+        
+        yield frame
+
+
+def _seek_frames(cap, stride, total_frames):
+    """Jump straight to each sampled frame instead of grabbing every frame"""
+    # OpenCV decodes forward from the nearest keyframe, which is fine for max counts
+    for frame_index in range(0, total_frames, stride):
+        cap.set(cv2.CAP_PROP_POS_FRAMES, frame_index)
+        ret, frame = cap.read()
+        if not ret:
+            break
+        
+        yield frame
+
+
+def _open_gpu_reader(video_path):
+    """Open ``video_path`` with decord on GPU 0, or return None when that is not possible"""
+    try:
+        # frames come back as torch tensors that stay on the GPU
+        decord.bridge.set_bridge('torch')
+        return decord.VideoReader(video_path, ctx=decord.gpu(0))
+    except Exception as e:
+        print(f"GPU decode unavailable for {video_path} ({e}), using OpenCV")
+        return None
+
+
+def _gpu_sampled_frames(reader, stride):
+    """Yield every ``stride``-th frame as a uint8 (H, W, 3) RGB CUDA tensor"""
+    for frame_index in range(0, len(reader), stride):
+        yield reader[frame_index]
+
+
+class _VideoJob:
+    """A video queued on the worker pool"""
+    
+    def __init__(self, video_path, ground_truth):
+        self.video_path = video_path
+        self.ground_truth = ground_truth
+        self.opened = False
+        self.future = Future()
+
+
+class VideoWorkerPool:
+    """Reader and detector threads reused for every video of an evaluation
+    
+    The reader thread decodes sampled frames while the detector thread runs
+    inference, so decoding overlaps with the model. The detector is only ever
+    called from its own thread.
+    """
+    
+    def __init__(self, detector, finish, stride=10, seek=False, prefetch=8,
+                 early_stop_frames=0, gpu_decode=False):
+        self.detector = detector
+        self.finish = finish  # (video_path, ground_truth, max_arr, stopped_at) -> result
+        self.stride = stride
+        self.seek = seek
+        
+        # Frames are buffered up to the detector's own model.batch_size
+        self.batch_size = detector.batch_size
+        
+        # Stop a video after this many sampled frames without a new maximum (0 = off)
+        self.early_stop_frames = early_stop_frames
+        
+        # Decode with decord on the GPU so frames skip the host copy and upload
+        self.gpu_decode = gpu_decode
+        
+        self._jobs = queue.Queue()
+        # Bounded so the reader blocks while the detector is behind
+        self._frames = queue.Queue(maxsize=prefetch)
+        
+        # Reopened for each video instead of constructing a new capture
+        self._cap = cv2.VideoCapture()
+        
+        self._reader = threading.Thread(target=self._read_loop, daemon=True)
+        self._worker = threading.Thread(target=self._detect_loop, daemon=True)
+        self._reader.start()
+        self._worker.start()
+    
+    def submit(self, video_path, ground_truth):
+        """Queue a video; the future resolves to its result, or None if it cannot be opened"""
+        job = _VideoJob(video_path, ground_truth)
+        self._jobs.put(job)
+        return job.future
+    
+    def close(self):
+        """Finish the queued videos and stop both threads"""
+        self._jobs.put(None)
+        self._reader.join()
+        self._worker.join()
+    
+    def _read_loop(self):
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                self._frames.put((None, _END_OF_STREAM))
+                break
+            
+            try:
+                reader = _open_gpu_reader(job.video_path) if self.gpu_decode else None
+                if reader is not None:
+                    job.opened = True
+                    frames = _gpu_sampled_frames(reader, self.stride)
+                else:
+                    job.opened = self._cap.open(job.video_path)
+                    if not job.opened:
+                        print(f"Cannot open video: {job.video_path}")
+                        continue
+                    
+                    self._cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+                    frames = _sampled_frames(self._cap, self.stride, self.seek)
+                
+                for frame in frames:
+                    # Stop decoding once the video has failed or stopped early
+                    if job.future.done():
+                        break
+                    self._frames.put((job, frame))
+            except Exception as e:
+                self._frames.put((job, e))
+            finally:
+                self._cap.release()
+                self._frames.put((job, _END_OF_STREAM))
+    
+    def _detect_loop(self):
+        batch = []
+        frames_done = 0
+        since_last_improve = 0
+        
+        # Store maximum counts per animal, in the detector's class order
+        max_arr = np.zeros(len(self.detector.class_names), dtype=np.int64)
+        
+        while True:
+            job, item = self._frames.get()
+            if job is None:
+                break
+            
+            # Drain the remaining frames of a finished or failed video
+            if job.future.done():
+                continue
+            
+            try:
+                if isinstance(item, Exception):
+                    raise item
+                
+                if item is not _END_OF_STREAM:
+                    batch.append(item)
+                    if len(batch) < self.batch_size:
+                        continue
+                
+                # Detect animals in the buffered frames
+                detections_list, counts_arr = self.detector.detect_batch(batch)
+                batch = []
+                
+                # Update maximum counts
+                stopped_at = None
+                for frame_arr in counts_arr:
+                    if np.any(frame_arr > max_arr):
+                        np.maximum(max_arr, frame_arr, out=max_arr)
+                        since_last_improve = 0
+                    else:
+                        since_last_improve += 1
+                    frames_done += 1
+                    
+                    # The maxima have plateaued; the rest of the video is skipped
+                    if self.early_stop_frames and since_last_improve >= self.early_stop_frames:
+                        stopped_at = (frames_done - 1) * self.stride
+                        break
+                
+                if item is _END_OF_STREAM or stopped_at is not None:
+                    result = None
+                    if job.opened:
+                        result = self.finish(job.video_path, job.ground_truth, max_arr, stopped_at)
+                    job.future.set_result(result)
+                    batch = []
+                    frames_done = since_last_improve = 0
+                    max_arr[:] = 0
+            except Exception as e:
+                job.future.set_exception(e)
+                batch = []
+                frames_done = since_last_improve = 0
+                max_arr[:] = 0
+
+
+@njit(cache=True)
+def _metric_kernel(pred, gt):
+    """Return (MAE, MAPE, exact matches, classes) for aligned count arrays"""
+    n = pred.shape[0]
+    if n == 0:
+        return 0.0, 0.0, 0, 0
+    
+    error_sum = 0.0
+    percentage_sum = 0.0
+    percentage_n = 0
+    correct = 0
+    
+    for i in range(n):
+        error = abs(pred[i] - gt[i])
+        error_sum += error
+        
+        # MAPE only covers classes with GT > 0
+        if gt[i] > 0:
+            percentage_sum += error / gt[i] * 100
+            percentage_n += 1
+        
+        if pred[i] == gt[i]:
+            correct += 1
+    
+    mape = percentage_sum / percentage_n if percentage_n else 0.0
+    return error_sum / n, mape, correct, n
+
+
+def _json_default(obj):
+    """Encode NumPy scalars/arrays that end up in a result dict"""
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    raise TypeError(f"Type is not JSON serializable: {type(obj).__name__}")
+
+
+def _dumps_line(result):
+    """Serialize 1 result as a compact JSON line"""
+    if orjson is not None:
+        return orjson.dumps(result, default=_json_default, option=orjson.OPT_SERIALIZE_NUMPY).decode() + "\n"
+    return json.dumps(result, separators=(',', ':'), default=_json_default) + "\n"
+
+
+def _ordered_classes(ground_truth, class_names):
+    """Ground truth classes in the config class order, unknown classes last"""
+    classes = [animal for animal in class_names if animal in ground_truth]
+    classes += sorted(set(ground_truth).difference(class_names))
+    return classes
+
+
+# Evaluator owned by a worker process of evaluate_all
+_worker_evaluator = None
+
+
+def _init_worker(config_path):
+    """Load the detector once per worker process"""
+    global _worker_evaluator
+    
+    # Parallelism comes from the process pool, so keep each worker single-threaded
+    cv2.setNumThreads(1)
+    _worker_evaluator = CountingEvaluator(config_path)
+
+
+def _evaluate_one(video_path, ground_truth_counts):
+    """Evaluate 1 video inside a worker process"""
+    return _worker_evaluator.evaluate_video(video_path, ground_truth_counts)
+
 
 class CountingEvaluator:
     def __init__(self, config_path="config/config.yaml"):
+        self.config_path = config_path
         self.config = load_config(config_path)
-        self.detector = SimpleAnimalDetector(config_path)
+        
+        # Class order of the detector's count arrays, taken from the config
+        self.class_names = get_class_names(config_path)
+        
         self.results = []
+        
+        # Only every Nth frame is decoded and run through the detector
+        self.stride = max(1, int(self.config.get('evaluation', {}).get('frame_stride', 10)))
+        
+        # Seek to sampled frames instead of grabbing through the whole stream
+        self.seek = self.config.get('evaluation', {}).get('seek', False)
+        
+        # Number of decoded frames buffered ahead of the detector
+        self.prefetch = self.config.get('evaluation', {}).get('prefetch', 8)
+        
+        # Stop a video once its maxima plateau for this many sampled frames (0 = off)
+        self.early_stop_frames = self.config.get('evaluation', {}).get('early_stop_frames', 0)
+        
+        # Decode on the GPU with decord (needs a CUDA build of decord)
+        self.gpu_decode = self.config.get('evaluation', {}).get('gpu_decode', False)
+        if self.gpu_decode and decord is None:
+            print("gpu_decode requested but decord is not installed, using OpenCV")
+            self.gpu_decode = False
+        elif self.gpu_decode and not isinstance(self.config['model'].get('imgsz', 640), int):
+            print("gpu_decode needs an integer model.imgsz, using OpenCV")
+            self.gpu_decode = False
+        
+        # Number of videos evaluated in parallel processes (1 = in-process)
+        self.workers = self.config.get('evaluation', {}).get('workers', 1)
+        
+        # Line-delimited results, appended as each video finishes
+        self.stream_file = self.config.get('evaluation', {}).get(
+            'stream_file', 'evaluation/counting_results.jsonl'
+        )
+        self._stream = None
+        
+        # Detector and pool are built on first in-process use, so with
+        # workers > 1 only the worker processes load a model
+        self.detector = None
+        self._pool = None
+    
+    def _get_pool(self):
+        """Reader and detector threads shared by every video"""
+        if self._pool is None:
+            self.detector = SimpleAnimalDetector(self.config_path)
+            self._pool = VideoWorkerPool(
+                self.detector,
+                self._finish_video,
+                stride=self.stride,
+                seek=self.seek,
+                prefetch=self.prefetch,
+                early_stop_frames=self.early_stop_frames,
+                gpu_decode=self.gpu_decode
+            )
+        return self._pool
     
     def evaluate_video(self, video_path, ground_truth_counts):
         """Evaluate the counting accuracy in the video"""
         print(f"\nEvaluating: {video_path}")
         
-        cap = cv2.VideoCapture(video_path)
-        if not cap.isOpened():
-            print(f"Cannot open video: {video_path}")
+        result = self._get_pool().submit(video_path, ground_truth_counts).result()
+        if result is None:
             return None
         
-        # Store maximum counts per animal
-        max_counts = defaultdict(int)
-        frame_count = 0
-        
-        while True:
-            ret, frame = cap.read()
-            if not ret:
-                break
-            
-            # Detect animals in frame
-            detections, counts = self.detector.detect_frame(frame)
-            
-            # Update maximum counts
-            for animal, count in counts.items():
-                max_counts[animal] = max(max_counts[animal], count)
-            
-            frame_count += 1
-        
-        cap.release()
+        self._record_result(result)
+        return result
+    
+    def _finish_video(self, video_path, ground_truth_counts, max_arr, stopped_at=None):
+        """Turn a video's maximum counts into its metric dict"""
+        max_counts = {
+            animal: int(max_arr[i])
+            for i, animal in enumerate(self.class_names)
+            if max_arr[i] > 0 or animal in ground_truth_counts
+        }
         
         # Calculate metrics
         result = self.calculate_metrics(
-            dict(max_counts), 
+            max_counts, 
             ground_truth_counts, 
             video_path
         )
         
-        self.results.append(result)
+        # Record whether the video was cut short by early stopping
+        result['early_stop'] = stopped_at is not None
+        if stopped_at is not None:
+            result['at_frame'] = stopped_at
+        
         return result
     
+    def close(self):
+        """Stop the worker pool threads"""
+        if self._pool is not None:
+            self._pool.close()
+    
+    def _record_result(self, result):
+        """Keep a result and append it to the JSONL stream if one is open"""
+        self.results.append(result)
+        
+        if self._stream is not None:
+            self._stream.write(_dumps_line(result))
+            self._stream.flush()
+    
     def calculate_metrics(self, predicted, ground_truth, video_name):
         """Calculate MAE, MAPE, and Accuracy"""
         
-        # Get all animals from ground truth
-        all_animals = set(ground_truth.keys())
-        
-        errors = []
-        percentage_errors = []
-        correct = 0
-        total = 0
-        
-        for animal in all_animals:
-            pred_count = predicted.get(animal, 0)
-            gt_count = ground_truth[animal]
-            
-            # Calculate MAE component
-            error = abs(pred_count - gt_count)
-            errors.append(error)
-            
-            # Calculate MAPE component (only for GT > 0)
-            if gt_count > 0:
-                percentage_errors.append((error / gt_count) * 100)
-            
-            # Check for exact match
-            if pred_count == gt_count:
-                correct += 1
-            total += 1
+        # Align predicted and ground truth counts over the ground truth classes
+        classes = _ordered_classes(ground_truth, self.class_names)
+        gt = np.fromiter((ground_truth[c] for c in classes), dtype=np.int32, count=len(classes))
+        pred = np.fromiter((predicted.get(c, 0) for c in classes), dtype=np.int32, count=len(classes))
         
         # Calculate final metrics
-        mae = sum(errors) / len(errors) if errors else 0
-        mape = sum(percentage_errors) / len(percentage_errors) if percentage_errors else 0
+        mae, mape, correct, total = _metric_kernel(pred, gt)
+        # Plain Python scalars: without numba the kernel returns NumPy ones
+        mae, mape, correct, total = float(mae), float(mape), int(correct), int(total)
         accuracy = (correct / total * 100) if total > 0 else 0
         
         return {
@@ -105,7 +452,8 @@ class CountingEvaluator:
         print("COUNTING ACCURACY EVALUATION")
         print("="*60)
         
-        # Evaluate each video
+        # Collect the videos to evaluate
+        jobs = []
         for video_path, gt_counts in all_ground_truths.items():
             # Handle relative paths
             if not os.path.isabs(video_path):
@@ -115,7 +463,20 @@ class CountingEvaluator:
                 print(f"Video not found: {video_path}")
                 continue
             
-            self.evaluate_video(video_path, gt_counts)
+            jobs.append((video_path, gt_counts))
+        
+        # Evaluate each video, streaming results so a crash keeps finished videos
+        os.makedirs(os.path.dirname(self.stream_file), exist_ok=True)
+        with open(self.stream_file, 'a') as stream:
+            self._stream = stream
+            try:
+                if self.workers > 1 and len(jobs) > 1:
+                    self._evaluate_parallel(jobs)
+                else:
+                    for video_path, gt_counts in jobs:
+                        self.evaluate_video(video_path, gt_counts)
+            finally:
+                self._stream = None
         
         # Display summary
         self.print_summary()
@@ -123,6 +484,36 @@ class CountingEvaluator:
         # Save results
         self.save_results()
     
+    def _evaluate_parallel(self, jobs):
+        """Evaluate videos concurrently, one detector per worker process"""
+        # spawn avoids forking an already initialised CUDA/OpenCV runtime
+        with ProcessPoolExecutor(
+            max_workers=min(self.workers, len(jobs)),
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=_init_worker,
+            initargs=(self.config_path,)
+        ) as executor:
+            # Workers inherit these before they import cv2/numpy/torch, so each one runs
+            # its native libraries single-threaded. Workers start during submit(), after
+            # which the parent's own settings are restored.
+            unset = [name for name in ('OMP_NUM_THREADS', 'MKL_NUM_THREADS') if name not in os.environ]
+            for name in unset:
+                os.environ[name] = '1'
+            try:
+                futures = [
+                    executor.submit(_evaluate_one, video_path, gt_counts)
+                    for video_path, gt_counts in jobs
+                ]
+            finally:
+                for name in unset:
+                    del os.environ[name]
+            
+            # Submission order keeps results and output files reproducible
+            for future in futures:
+                result = future.result()
+                if result is not None:
+                    self._record_result(result)
+    
     def print_summary(self):
         """Display evaluation results summary"""
         if not self.results:
@@ -140,7 +531,7 @@ class CountingEvaluator:
             print(f"   Accuracy: {result['accuracy']:.2f}% ({result['correct_counts']}/{result['total_classes']} exact)")
             
             print("\n   Details:")
-            for animal in result['ground_truth'].keys():
+            for animal in _ordered_classes(result['ground_truth'], self.class_names):
                 pred = result['predicted'].get(animal, 0)
                 gt = result['ground_truth'][animal]
                 diff = pred - gt
@@ -165,7 +556,7 @@ class CountingEvaluator:
         os.makedirs(os.path.dirname(output_file), exist_ok=True)
         
         with open(output_file, 'w') as f:
-            json.dump(self.results, f, indent=2)
+            json.dump(self.results, f, indent=2, default=_json_default)
         
         print(f"\nResults saved to: {output_file}")
 
@@ -182,4 +573,7 @@ if __name__ == "__main__":
     
     # Run evaluation
     evaluator = CountingEvaluator()
-    evaluator.evaluate_all(args.ground_truth)
\ No newline at end of file
+    try:
+        evaluator.evaluate_all(args.ground_truth)
+    finally:
+        evaluator.close()
\ No newline at end of file
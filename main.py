@@ -2,7 +2,11 @@ import cv2
 import time
 import yaml
 import os
+import queue
+import signal
 import sys
+import threading
+from collections import deque
 
 # เพิ่ม project root path
 project_root = os.path.dirname(os.path.abspath(__file__))
@@ -24,11 +28,22 @@ class COCOAnimalDetectionApp:
         self.video_source = self.config['video']['source']
         self.save_output = self.config['video']['save_output']
         self.output_path = self.config['video']['output_path']
+        self.display = self.config['video'].get('display', True)
+        self.stop = False
+        
+        # ตาราง COCO ID ของสัตว์แต่ละชนิด
+        self.coco_id_by_name = {
+            item['name']: item['coco_id'] for item in self.config['animals']['classes']
+        }
         
         # ตัวแปรสำหรับ performance
         self.frame_count = 0
         self.last_save_time = time.time()
         
+        # คิวสำหรับเขียน database ใน background thread
+        self.db_q = queue.Queue(maxsize=100)
+        self.db_thread = None
+        
         print("COCO Animal Detection System Initialized")
         print(f"Video Source: {self.video_source}")
         print(f"Target Animals: {len(self.detector.animal_classes)} classes")
@@ -37,7 +52,10 @@ class COCOAnimalDetectionApp:
         """เริ่มการตรวจจับสัตว์"""
         print("\nStarting COCO Animal Detection System...")
         print("Detecting: Horse, Sheep, Cow, Elephant, Bear, Zebra, Giraffe")
-        print("Press 'q' to quit, 's' to save current stats, 'i' to show info")
+        if self.display:
+            print("Press 'q' to quit, 's' to save current stats, 'i' to show info")
+        else:
+            print("Running headless, press Ctrl+C to stop")
         
         # เปิด video source
         cap = cv2.VideoCapture(self.video_source)
@@ -58,11 +76,33 @@ class COCOAnimalDetectionApp:
             out = cv2.VideoWriter(self.output_path, fourcc, fps, (width, height))
             print(f"Recording to: {self.output_path}")
         
+        # เริ่ม thread สำหรับเขียน database
+        self.db_thread = threading.Thread(target=self._db_writer, daemon=True)
+        self.db_thread.start()
+        
         # Performance tracking
-        fps_history = []
+        fps_history = deque(maxlen=30)  # เก็บ 30 frames ล่าสุด
+        fps_sum = 0.0
+        
+        # ไม่ต้องวาดอะไรบน frame ถ้าไม่มีใครเห็นหรือบันทึก
+        need_annotated = self.display or self.save_output
+        
+        # ข้อความ HUD จะสร้างใหม่เฉพาะเมื่อค่าเปลี่ยน
+        hud_x = None
+        last_fps_value = None
+        last_detection_count = None
+        fps_text = ""
+        detections_text = ""
+        
+        # โหมด headless ไม่มีหน้าต่างรับ keyboard ใช้ SIGINT เพื่อหยุดแทน
+        previous_sigint = None
+        if not self.display:
+            previous_sigint = signal.signal(signal.SIGINT, self._request_stop)
+        
+        self.stop = False
         
         try:
-            while True:
+            while not self.stop:
                 start_time = time.time()
                 
                 ret, frame = cap.read()
@@ -70,47 +110,71 @@ class COCOAnimalDetectionApp:
                     print(" End of video stream")
                     break
                 
+                # ความละเอียดของ video คงที่ คำนวณตำแหน่ง HUD ครั้งเดียว
+                if hud_x is None:
+                    hud_x = frame.shape[1] - 150
+                
                 # ตรวจจับสัตว์
                 detections, frame_counts = self.detector.detect_frame(frame)
                 
-                # วาดผลลัพธ์
-                frame = self.detector.draw_detections(frame, detections)
-                frame = self.detector.draw_statistics(frame)
+                # วาดผลลัพธ์ เฉพาะเมื่อมีการแสดงผลหรือบันทึก video
+                if need_annotated:
+                    frame = self.detector.draw_detections(frame, detections)
+                    frame = self.detector.draw_statistics(frame)
                 
-                # คำนวณและแสดง FPS
+                # คำนวณ FPS
                 processing_time = time.time() - start_time
                 fps = 1.0 / processing_time if processing_time > 0 else 0
+                if len(fps_history) == fps_history.maxlen:
+                    fps_sum -= fps_history[0]
                 fps_history.append(fps)
+                fps_sum += fps
                 
-                if len(fps_history) > 30:  # เก็บ 30 frames ล่าสุด
-                    fps_history.pop(0)
-                
-                avg_fps = sum(fps_history) / len(fps_history)
+                avg_fps = fps_sum / len(fps_history)
                 
                 # แสดง FPS และข้อมูลเพิ่มเติม
-                cv2.putText(frame, f"FPS: {avg_fps:.1f}", 
-                           (frame.shape[1] - 150, 30), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 255, 0), 2)
-                cv2.putText(frame, f"Frame: {self.frame_count}", 
-                           (frame.shape[1] - 150, 60), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 2)
-                cv2.putText(frame, f"Detections: {len(detections)}", 
-                           (frame.shape[1] - 150, 85), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 2)
+                if need_annotated:
+                    fps_value = round(avg_fps, 1)
+                    if fps_value != last_fps_value:
+                        fps_text = f"FPS: {fps_value:.1f}"
+                        last_fps_value = fps_value
+                    
+                    if len(detections) != last_detection_count:
+                        detections_text = f"Detections: {len(detections)}"
+                        last_detection_count = len(detections)
+                    
+                    cv2.putText(frame, fps_text, 
+                               (hud_x, 30), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 255, 0), 2)
+                    cv2.putText(frame, f"Frame: {self.frame_count}", 
+                               (hud_x, 60), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 2)
+                    cv2.putText(frame, detections_text, 
+                               (hud_x, 85), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 2)
                 
                 # บันทึกข้อมูลลง database ทุก 15 วินาที
                 current_time = time.time()
                 if current_time - self.last_save_time >= 15:
                     if frame_counts:
-                        self.database.save_animal_counts(frame_counts)
-                        print(f"Saved to database: {frame_counts}")
+                        try:
+                            # แปลงเป็น dict เฉพาะตอนบันทึก
+                            self.db_q.put_nowait(frame_counts.as_dict())
+                        except queue.Full:
+                            print("Database queue full, skipping save")
                     self.last_save_time = current_time
                 
                 # แสดงผล
-                cv2.imshow('COCO Animal Detection System', frame)
+                if self.display:
+                    cv2.imshow('COCO Animal Detection System', frame)
                 
                 # บันทึก video output
                 if self.save_output:
                     out.write(frame)
                 
+                self.frame_count += 1
+                
                 # จัดการ keyboard input
+                if not self.display:
+                    continue
+                
                 key = cv2.waitKey(1) & 0xFF
                 if key == ord('q'):
                     print("Quit requested")
@@ -120,8 +184,6 @@ class COCOAnimalDetectionApp:
                 elif key == ord('i'):
                     self.show_detection_info(detections)
                 
-                self.frame_count += 1
-                
         except KeyboardInterrupt:
             print("\nStopping detection...")
         
@@ -130,12 +192,36 @@ class COCOAnimalDetectionApp:
             cap.release()
             if self.save_output:
                 out.release()
-            cv2.destroyAllWindows()
+            if self.display:
+                cv2.destroyAllWindows()
+            else:
+                signal.signal(signal.SIGINT, previous_sigint)
+            
+            # รอให้เขียนข้อมูลที่ค้างอยู่ลง database ให้เสร็จ
+            self.db_q.put(None)
+            self.db_thread.join(timeout=10)
+            self.database.close()
             
             print(f"Processed {self.frame_count} frames")
-            print(f"Average FPS: {sum(fps_history) / len(fps_history):.2f}")
+            if fps_history:
+                print(f"Average FPS: {fps_sum / len(fps_history):.2f}")
             self.save_stats()
     
+    def _request_stop(self, signum, frame):
+        """หยุด loop หลักเมื่อได้รับ SIGINT ในโหมด headless"""
+        print("\nStopping detection...")
+        self.stop = True
+    
+    def _db_writer(self):
+        """เขียนจำนวนสัตว์ลง database โดยไม่บล็อก loop หลัก"""
+        while True:
+            frame_counts = self.db_q.get()
+            if frame_counts is None:
+                break
+            
+            if self.database.save_animal_counts(frame_counts):
+                print(f"Saved to database: {frame_counts}")
+    
     def save_stats(self):
         """บันทึกและแสดงสถิติ"""
         summary = self.detector.get_summary()
@@ -149,11 +235,9 @@ class COCOAnimalDetectionApp:
         for animal, display_name in self.detector.animal_classes.items():
             current = summary['current_counts'].get(animal, 0)
             maximum = summary['max_counts'].get(animal, 0)
-    
-            coco_id = next((item['coco_id'] for item in self.config['animals']['classes'] 
-                   if item['name'] == animal), '?')
-    
-        print(f"{animal} [COCO {coco_id}]: {current} (Max: {maximum})")  
+            coco_id = self.coco_id_by_name.get(animal, '?')
+            
+            print(f"{animal} [COCO {coco_id}]: {current} (Max: {maximum})")
         
         print("-" * 50)
         print(f"Total Current: {summary['total_animals']}")
@@ -9,20 +9,28 @@ __version__ = "1.0.0"
 __author__ = "Animal Detection Team"
 
 # Core modules
-from .detector import SimpleAnimalDetector
+from .detector import SimpleAnimalDetector, FrameSummary
 from .database import SimpleInfluxDB, create_database, test_database_connection
 
 # Configuration
+import functools
 import os
-import yaml
+from ._yaml import read_yaml
+
+@functools.lru_cache(maxsize=8)
+def _load_config_cached(config_path, mtime):
+    """Parse a YAML config file; ``mtime`` keys the cache so edits are picked up"""
+    return read_yaml(config_path)
 
 def load_config(config_path="config/config.yaml"):
-    """Load configuration from YAML file"""
+    """Load configuration from YAML file
+
+    The parsed config is cached and shared between callers, so treat it as read-only.
+    """
     if not os.path.exists(config_path):
         raise FileNotFoundError(f"Configuration file not found: {config_path}")
     
-    with open(config_path, 'r', encoding='utf-8') as file:
-        return yaml.safe_load(file)
+    return _load_config_cached(config_path, os.path.getmtime(config_path))
 
 def get_animal_classes():
     """Get list of supported animal classes"""
@@ -36,6 +44,10 @@ def get_animal_classes():
         })
     return animals
 
+def get_class_names(config_path="config/config.yaml"):
+    """Animal names in config order, the class order of every count array"""
+    return tuple(animal['name'] for animal in load_config(config_path)['animals']['classes'])
+
 def get_version():
     """Get current version"""
     return __version__
@@ -88,11 +100,13 @@ def check_system_requirements():
 # Export main classes and functions
 __all__ = [
     'SimpleAnimalDetector',
+    'FrameSummary',
     'SimpleInfluxDB', 
     'create_database',
     'test_database_connection',
     'load_config',
     'get_animal_classes',
+    'get_class_names',
     'get_version',
     'create_detection_system',
     'check_system_requirements',
@@ -0,0 +1,12 @@
+import yaml
+
+# libyaml's C parser when PyYAML was built with it
+try:
+    from yaml import CSafeLoader as _YamlLoader
+except ImportError:
+    from yaml import SafeLoader as _YamlLoader
+
+def read_yaml(path):
+    """Parse a YAML file with the fastest available safe loader"""
+    with open(path, 'r', encoding='utf-8') as file:
+        return yaml.load(file, Loader=_YamlLoader)
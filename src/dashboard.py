@@ -2,6 +2,7 @@ import streamlit as st
 import pandas as pd
 import plotly.express as px
 import plotly.graph_objects as go
+import plotly.io as pio
 from datetime import datetime, timedelta
 import time
 import numpy as np
@@ -13,12 +14,64 @@ import sys
 import os
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
 
-from src import SimpleInfluxDB, load_config
+from src import SimpleInfluxDB, load_config, get_class_names
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Serialize figures with orjson when it is installed
+try:
+    import orjson
+    pio.json.config.default_engine = "orjson"
+except ImportError:
+    pass
+
+# How long query results are reused across reruns (seconds)
+QUERY_CACHE_TTL = 30
+
+# Trend chart bins per time range (hours). History already arrives as
+# 2-minute means, so only the 24 hour view needs coarser bins.
+TREND_RESAMPLE_RULES = {24: '5min'}
+
+@st.cache_resource
+def get_database(config_path="config/config.yaml"):
+    """Share one InfluxDB client across reruns and sessions"""
+    return SimpleInfluxDB(config_path)
+
+# The fetch_* helpers below take bucket, org and url only to key the cache
+@st.cache_data(ttl=QUERY_CACHE_TTL, show_spinner=False)
+def fetch_animal_history(hours, bucket, org, url):
+    """Animal count history as a DataFrame, or None when the query fails"""
+    df = get_database().get_animal_history_arrow(hours)
+    if df is None:
+        return None
+    
+    df = df.rename(columns={'_time': 'time', '_value': 'count'})
+    # Categorical keys let groupby hash int8 codes instead of Python strings
+    df['animal_type'] = pd.Categorical(df['animal_type'], categories=get_class_names())
+    df['count'] = df['count'].astype('int32')
+    df['time'] = pd.to_datetime(df['time'], utc=True)
+    return df
+
+@st.cache_data(ttl=QUERY_CACHE_TTL, show_spinner=False)
+def fetch_animal_latest_counts(hours, bucket, org, url):
+    """Highest count per animal type, or None when the query fails"""
+    return get_database().get_animal_latest_counts(hours)
+
+@st.cache_data(ttl=QUERY_CACHE_TTL, show_spinner=False)
+def fetch_performance_stats(hours, bucket, org, url):
+    """FPS and processing time history as two DataFrames, or None when there is no data"""
+    df = get_database().get_performance_stats_df(hours)
+    if df is None or df.empty:
+        return None
+    
+    df = df.rename(columns={'_time': 'time', '_value': 'value'})
+    return (
+        df.loc[df['_field'] == 'fps', ['time', 'value']],
+        df.loc[df['_field'] == 'processing_time_ms', ['time', 'value']]
+    )
+
 class RealDataDashboard:
     def __init__(self):
         st.set_page_config(
@@ -31,7 +84,7 @@ class RealDataDashboard:
         # load config
         try:
             self.config = load_config("config/config.yaml")
-            self.db = SimpleInfluxDB()
+            self.db = get_database()
             
             # Prepare animal information
             self.animals_data = {}
@@ -42,6 +95,11 @@ class RealDataDashboard:
                     'color': f"rgb({animal['color'][0]}, {animal['color'][1]}, {animal['color'][2]})"
                 }
             
+            # Chart colors and name order are fixed for the session, build them once
+            self._colors = ['#ff6b6b', '#4ecdc4', '#45b7d1', '#96ceb4', '#fef65b', '#ff9ff3', '#54a0ff']
+            self._color_map = dict(zip(self.animals_data, self._colors))
+            self._animal_names = tuple(self.animals_data)
+            
             self.time_mapping = {
                 "Last Hour": 1,
                 "Last 6 Hours": 6, 
@@ -56,8 +114,12 @@ class RealDataDashboard:
         st.title("Animal Detection Dashboard")
         st.markdown("**Real-time data from InfluxDB: Horse, Sheep, Cow, Elephant, Bear, Zebra, Giraffe**")
         
+        # Connection state and settings are read once per rerun
+        connected = self.db.is_connected()
+        db_config = self.db.db_config
+        
         # Connection status
-        if self.db.is_connected():
+        if connected:
             st.success("✅ Connected to InfluxDB")
         else:
             st.error("❌ InfluxDB Connection Failed - Showing sample data")
@@ -70,11 +132,11 @@ class RealDataDashboard:
             
             # Database connection info
             st.subheader("🗄️ Database Info")
-            if self.db.is_connected():
+            if connected:
                 st.success("✅ InfluxDB Connected")
-                st.write(f"**URL:** {self.db.db_config['url']}")
-                st.write(f"**Org:** {self.db.db_config['org']}")
-                st.write(f"**Bucket:** {self.db.db_config['bucket']}")
+                st.write(f"**URL:** {db_config['url']}")
+                st.write(f"**Org:** {db_config['org']}")
+                st.write(f"**Bucket:** {db_config['bucket']}")
             else:
                 st.error("❌ InfluxDB Disconnected")
                 
@@ -116,17 +178,21 @@ class RealDataDashboard:
         # Main content
         hours = self.time_mapping[time_range]
         
+        # Fetch each data set once per rerun
+        animal_counts, df = self.get_real_animal_counts(hours)
+        perf_stats = self.get_performance_stats(hours)
+        
         # Show current stats
-        self.show_current_stats(hours)
+        self.show_current_stats(animal_counts, df, hours, perf_stats, connected)
         
         # Show charts with real data
-        self.show_real_charts(hours)
+        self.show_real_charts(animal_counts, df, hours)
         
         # Show system performance
-        self.show_system_performance(hours)
+        self.show_system_performance(hours, perf_stats)
         
         # Show database info
-        self.show_database_info()
+        self.show_database_info(connected)
         
         # Auto refresh logic
         if auto_refresh:
@@ -136,42 +202,57 @@ class RealDataDashboard:
     def get_real_animal_counts(self, hours):
         """Retrieve the actual animal count data from InfluxDB."""
         try:
-            # Retrieve data from database
-            result = self.db.get_animal_history(hours)
-            
-            if result is None:
-                return self.get_sample_data()
+            # Retrieve data from database (cached for QUERY_CACHE_TTL seconds)
+            df = fetch_animal_history(hours, *self._cache_key())
             
-            # Transform data to DataFrame
-            data_points = []
-            for table in result:
-                for record in table.records:
-                    data_points.append({
-                        'time': record.get_time(),
-                        'animal_type': record.values.get('animal_type'),
-                        'count': int(record.get_value())
-                    })
-            
-            if not data_points:
+            if df is None or df.empty:
                 return self.get_sample_data()
             
-            df = pd.DataFrame(data_points)
-            
-            # Calculate the number of each type of animal (take the highest value)
-            latest_counts = df.groupby('animal_type')['count'].max().to_dict()
-            
-            # Add 0 for animals with no data.
-            animal_counts = {}
-            for animal_name in self.animals_data.keys():
-                animal_counts[animal_name] = latest_counts.get(animal_name, 0)
-            
-            return animal_counts, df
+            # The number of each type of animal (highest value) is reduced in Flux
+            return self.get_latest_animal_counts(hours, df), df
             
         except Exception as e:
             logger.error(f"Error fetching real data: {e}")
             st.warning(f"⚠️ Using sample data due to: {str(e)}")
             return self.get_sample_data()
     
+    def get_latest_animal_counts(self, hours, df):
+        """Retrieve the highest count of each animal from InfluxDB.
+        
+        Falls back to the maxima of ``df`` so the counts always match the history.
+        """
+        try:
+            # Only 1 row per animal type comes back from the server
+            latest_counts = fetch_animal_latest_counts(hours, *self._cache_key())
+        except Exception as e:
+            logger.error(f"Error fetching latest counts: {e}")
+            latest_counts = None
+        
+        if not latest_counts:
+            latest_counts = df.groupby('animal_type', observed=True)['count'].max().to_dict()
+        
+        # Add 0 for animals with no data.
+        return {
+            animal_name: int(latest_counts.get(animal_name, 0))
+            for animal_name in self.animals_data.keys()
+        }
+    
+    def get_performance_stats(self, hours):
+        """Retrieve FPS and processing time DataFrames, or None"""
+        try:
+            return fetch_performance_stats(hours, *self._cache_key())
+        except Exception as e:
+            logger.error(f"Error fetching performance data: {e}")
+            return None
+    
+    def _cache_key(self):
+        """Connection settings that key the cached queries"""
+        return (
+            self.db.db_config['bucket'],
+            self.db.db_config['org'],
+            self.db.db_config['url']
+        )
+    
     def get_sample_data(self):
         """Sample data when unable to connect to database"""
         sample_counts = {
@@ -184,47 +265,40 @@ class RealDataDashboard:
             'giraffe': int(np.random.randint(4, 10))
         }
         
-        # Build sample DataFrame
-        times = pd.date_range(end=datetime.now(), periods=20, freq='3T')
-        sample_data = []
-        
-        for animal, base_count in sample_counts.items():
-            for time in times:
-                count = int(base_count + np.random.randint(-5, 6))
-                sample_data.append({
-                    'time': time,
-                    'animal_type': animal,
-                    'count': max(0, count)
-                })
-        
-        df = pd.DataFrame(sample_data)
+        # Build sample DataFrame: one row per (animal, time)
+        n_times = 20
+        times = pd.date_range(end=datetime.now(), periods=n_times, freq='3min')
+        base = np.fromiter(sample_counts.values(), dtype=np.int64)
+        noise = np.random.randint(-5, 6, size=(len(base), n_times))
+        counts = np.clip(base[:, None] + noise, 0, None)
+        
+        df = pd.DataFrame({
+            'time': np.tile(times, len(base)),
+            'animal_type': pd.Categorical(np.repeat(list(sample_counts), n_times), categories=self._animal_names),
+            'count': counts.ravel().astype(np.int32)
+        })
         return sample_counts, df
     
-    def show_current_stats(self, hours):
+    def show_current_stats(self, animal_counts, df, hours, perf_stats=None, connected=None):
         """Show current statistics from real data"""
-        st.subheader("📊 Current Detection Statistics")
+        if connected is None:
+            connected = self.db.is_connected()
         
-        # Extract real data
-        animal_counts, df = self.get_real_animal_counts(hours)
+        st.subheader("📊 Current Detection Statistics")
         
         # Calculate statistics
         total_animals = int(sum(animal_counts.values()))
-        active_types = len([count for count in animal_counts.values() if count > 0])
+        active_types = sum(1 for count in animal_counts.values() if count > 0)
         
         # Extract real performance
         try:
-            perf_result = self.db.get_performance_stats(1)  # Last hour
             avg_fps = 28.5  # Default
             
-            if perf_result:
-                fps_data = []
-                for table in perf_result:
-                    for record in table.records:
-                        if record.values.get('_field') == 'fps':
-                            fps_data.append(record.get_value())
-                
-                if fps_data:
-                    avg_fps = np.mean(fps_data)
+            if perf_stats is not None:
+                fps_df, _ = perf_stats
+                if not fps_df.empty:
+                    # Reduced in pandas, no per-record Python loop
+                    avg_fps = float(fps_df['value'].mean())
                     
         except Exception:
             avg_fps = 28.5
@@ -253,32 +327,24 @@ class RealDataDashboard:
             )
         
         with col4:
-            status = "🟢 Online" if self.db.is_connected() else "🔴 Offline"
+            status = "🟢 Online" if connected else "🔴 Offline"
             st.metric(
                 "📹 System Status", 
-                "Online" if self.db.is_connected() else "Offline",
+                "Online" if connected else "Offline",
                 delta=status
             )
     
-    def show_real_charts(self, hours):
+    def show_real_charts(self, animal_counts, df, hours):
         """Show graphs from real data"""
         st.subheader("📈 Animal Detection Trends (Real Data)")
         
-        # Extract Real data
-        animal_counts, df = self.get_real_animal_counts(hours)
-        
         col1, col2 = st.columns(2)
         
         with col1:
             # Bar chart from real data
             if animal_counts:
-                animals = []
-                counts = []
-                
-                for name, data in self.animals_data.items():
-                    if name in animal_counts:
-                        animals.append(f"{name}")
-                        counts.append(animal_counts[name])
+                animals = [name for name in self._animal_names if name in animal_counts]
+                counts = [animal_counts[name] for name in animals]
                 
                 fig_bar = px.bar(
                     x=animals, 
@@ -334,21 +400,33 @@ class RealDataDashboard:
             # build time series chart
             fig_time = go.Figure()
             
-            colors = ['#ff6b6b', '#4ecdc4', '#45b7d1', '#96ceb4', '#fef65b', '#ff9ff3', '#54a0ff']
-            color_map = dict(zip(self.animals_data.keys(), colors))
+            # Downsample long ranges so fewer points are serialized to the browser
+            rule = TREND_RESAMPLE_RULES.get(hours)
+            if rule:
+                df_trend = (
+                    df.set_index('time')
+                    .groupby('animal_type', observed=True)['count']
+                    .resample(rule).mean()
+                    .dropna()
+                    .reset_index()
+                )
+            else:
+                df_trend = df.sort_values('time')
             
-            for animal in self.animals_data.keys():
-                animal_data = df[df['animal_type'] == animal].sort_values('time')
+            # One groupby pass instead of a mask + sort per animal; sorting follows the
+            # Categorical's config class order, so trace and legend order stay fixed
+            for animal, animal_data in df_trend.groupby('animal_type', observed=True):
+                if animal not in self.animals_data or animal_data.empty:
+                    continue
                 
-                if not animal_data.empty:
-                    fig_time.add_trace(go.Scatter(
-                        x=animal_data['time'],
-                        y=animal_data['count'],
-                        mode='lines+markers',
-                        name=f"{animal} ({animal})",
-                        line=dict(color=color_map.get(animal, '#888888')),
-                        marker=dict(size=6)
-                    ))
+                fig_time.add_trace(go.Scatter(
+                    x=animal_data['time'],
+                    y=animal_data['count'],
+                    mode='lines+markers',
+                    name=f"{animal} ({animal})",
+                    line=dict(color=self._color_map.get(animal, '#888888')),
+                    marker=dict(size=6)
+                ))
             
             fig_time.update_layout(
                 title=f"Animal Count By Type (Last {hours} Hours)",
@@ -367,45 +445,24 @@ class RealDataDashboard:
         # update present data
         if not df.empty:
             with st.expander("📋 Recent Detection Data"):
-                # show last 10 records
-                recent_data = df.sort_values('time', ascending=False).head(10)
-                recent_data['thai_name'] = recent_data['animal_type'].map(
-                    lambda x: self.animals_data.get(x, {}).get('thai_name', x)
-                )
-                
-                display_df = recent_data[['time', 'animal_type', 'count']].copy()
-                display_df.columns = ['Time', 'Animal Type', 'Count']  
+                # show last 10 records (partial selection instead of a full sort)
+                display_df = df.nlargest(10, 'time')[['time', 'animal_type', 'count']]
+                display_df.columns = ['Time', 'Animal Type', 'Count']
                 
                 st.dataframe(display_df, use_container_width=True)
     
-    def show_system_performance(self, hours):
+    def show_system_performance(self, hours, perf_stats):
         """Display system performance information"""
         st.subheader("⚡ System Performance Metrics")
         
         try:
-            perf_result = self.db.get_performance_stats(hours)
-            
-            if perf_result:
-                fps_data = []
-                processing_data = []
-                times = []
-                
-                for table in perf_result:
-                    for record in table.records:
-                        field = record.values.get('_field')
-                        time_val = record.get_time()
-                        value = record.get_value()
-                        
-                        if field == 'fps':
-                            fps_data.append({'time': time_val, 'value': value})
-                        elif field == 'processing_time_ms':
-                            processing_data.append({'time': time_val, 'value': value})
+            if perf_stats:
+                fps_df, proc_df = perf_stats
                 
                 col1, col2 = st.columns(2)
                 
                 with col1:
-                    if fps_data:
-                        fps_df = pd.DataFrame(fps_data)
+                    if not fps_df.empty:
                         fig_fps = px.line(
                             fps_df, x='time', y='value',
                             title='FPS Over Time',
@@ -420,8 +477,7 @@ class RealDataDashboard:
                         st.info("No FPS data available")
                 
                 with col2:
-                    if processing_data:
-                        proc_df = pd.DataFrame(processing_data)
+                    if not proc_df.empty:
                         fig_proc = px.line(
                             proc_df, x='time', y='value',
                             title='Processing Time',
@@ -436,8 +492,11 @@ class RealDataDashboard:
         except Exception as e:
             st.error(f"Error loading performance data: {e}")
     
-    def show_database_info(self):
+    def show_database_info(self, connected=None):
         """Display database information and COCO classes"""
+        if connected is None:
+            connected = self.db.is_connected()
+        
         st.subheader("ℹ️ System Information")
         
         col1, col2 = st.columns(2)
@@ -449,7 +508,7 @@ class RealDataDashboard:
         
         with col2:
             st.success("**Database Status:**")
-            if self.db.is_connected():
+            if connected:
                 st.write("✅ InfluxDB Connected")
                 st.write(f"📊 Bucket: {self.db.bucket}")
                 st.write(f"🏢 Organization: {self.db.org}")
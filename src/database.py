@@ -1,11 +1,29 @@
-import yaml
-from influxdb_client import InfluxDBClient, Point
-from influxdb_client.client.write_api import SYNCHRONOUS
+import pandas as pd
+from influxdb_client import InfluxDBClient, Point, Dialect
+from influxdb_client.client.write_api import SYNCHRONOUS, WriteOptions
+from influxdb_client.domain.write_precision import WritePrecision
 from datetime import datetime, timezone
-import pytz
+from io import BytesIO
+from time import time_ns
 import os
 
-THAILAND_TZ = pytz.timezone('Asia/Bangkok')
+try:
+    from ._yaml import read_yaml
+except ImportError:
+    # run directly as a script (python src/database.py)
+    from _yaml import read_yaml
+
+# pyarrow is optional; without it history is parsed by query_data_frame
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+except ImportError:
+    pa = None
+
+def _escape_tag(value):
+    """Escape a tag value for InfluxDB line protocol"""
+    return str(value).replace('\\', '\\\\').replace(',', '\\,').replace('=', '\\=').replace(' ', '\\ ')
+
 
 class SimpleInfluxDB:
     def __init__(self, config_path="config/config.yaml"):
@@ -14,8 +32,7 @@ class SimpleInfluxDB:
         if not os.path.exists(config_path):
             raise FileNotFoundError(f"Config file not found: {config_path}")
             
-        with open(config_path, 'r', encoding='utf-8') as file:
-            config = yaml.safe_load(file)
+        config = read_yaml(config_path)
         
         self.db_config = config['influxdb']
         
@@ -27,10 +44,20 @@ class SimpleInfluxDB:
                 org=self.db_config['org']
             )
             
-            self.write_api = self.client.write_api(write_options=SYNCHRONOUS)
+            # Points are buffered and flushed in the background, so save_* calls
+            # return immediately; close() flushes anything still pending
+            self.write_api = self.client.write_api(write_options=WriteOptions(
+                batch_size=500,
+                flush_interval=1000,
+                jitter_interval=200,
+                retry_interval=5000
+            ))
+            # Blocking writes for connection tests, which need the server's answer
+            self.sync_write_api = self.client.write_api(write_options=SYNCHRONOUS)
             self.query_api = self.client.query_api()
             self.bucket = self.db_config['bucket']
             self.org = self.db_config['org']
+            self._build_queries()
             
             print(f"InfluxDB connected: {self.db_config['url']}")
             
@@ -39,6 +66,87 @@ class SimpleInfluxDB:
             print("Make sure InfluxDB is running and config is correct")
             self.client = None
     
+    def _build_queries(self):
+        """Bake the bucket into the Flux queries once; only hours/animal_type vary per call"""
+        self._q_animal_type_history = f'''
+        from(bucket: "{self.bucket}")
+          |> range(start: -{{hours}}h)
+          |> filter(fn: (r) => r["_measurement"] == "animal_counts")
+          |> filter(fn: (r) => r["animal_type"] == "{{animal_type}}")
+          |> filter(fn: (r) => r["_field"] == "count")
+          |> aggregateWindow(every: 2m, fn: mean, createEmpty: false)
+          |> yield(name: "mean")
+        '''
+        
+        self._q_animal_history = f'''
+        from(bucket: "{self.bucket}")
+          |> range(start: -{{hours}}h)
+          |> filter(fn: (r) => r["_measurement"] == "animal_counts")
+          |> filter(fn: (r) => r["_field"] == "count")
+          |> group(columns: ["animal_type"])
+          |> aggregateWindow(every: 2m, fn: mean, createEmpty: false)
+          |> yield(name: "mean")
+        '''
+        
+        self._q_animal_history_df = f'''
+        from(bucket: "{self.bucket}")
+          |> range(start: -{{hours}}h)
+          |> filter(fn: (r) => r["_measurement"] == "animal_counts")
+          |> filter(fn: (r) => r["_field"] == "count")
+          |> group(columns: ["animal_type"])
+          |> aggregateWindow(every: 2m, fn: mean, createEmpty: false)
+          |> keep(columns: ["_time", "animal_type", "_value"])
+          |> yield(name: "mean")
+        '''
+        
+        self._q_latest_counts = f'''
+        from(bucket: "{self.bucket}")
+          |> range(start: -{{hours}}h)
+          |> filter(fn: (r) => r["_measurement"] == "animal_counts")
+          |> filter(fn: (r) => r["_field"] == "count")
+          |> group(columns: ["animal_type"])
+          |> aggregateWindow(every: 2m, fn: mean, createEmpty: false)
+          |> max()
+          |> yield(name: "max")
+        '''
+        
+        self._q_total_history = f'''
+        from(bucket: "{self.bucket}")
+          |> range(start: -{{hours}}h)
+          |> filter(fn: (r) => r["_measurement"] == "total_animals")
+          |> filter(fn: (r) => r["_field"] == "total_count")
+          |> aggregateWindow(every: 2m, fn: mean, createEmpty: false)
+          |> yield(name: "mean")
+        '''
+        
+        self._q_detection_summary = f'''
+        from(bucket: "{self.bucket}")
+          |> range(start: -{{hours}}h)
+          |> filter(fn: (r) => r["_measurement"] == "detection_details")
+          |> group(columns: ["animal_type"])
+          |> count()
+          |> yield(name: "count")
+        '''
+        
+        self._q_performance = f'''
+        from(bucket: "{self.bucket}")
+          |> range(start: -{{hours}}h)
+          |> filter(fn: (r) => r["_measurement"] == "system_performance")
+          |> filter(fn: (r) => r["_field"] == "fps" or r["_field"] == "processing_time_ms")
+          |> aggregateWindow(every: 5m, fn: mean, createEmpty: false)
+          |> yield(name: "mean")
+        '''
+        
+        self._q_performance_df = f'''
+        from(bucket: "{self.bucket}")
+          |> range(start: -{{hours}}h)
+          |> filter(fn: (r) => r["_measurement"] == "system_performance")
+          |> filter(fn: (r) => r["_field"] == "fps" or r["_field"] == "processing_time_ms")
+          |> aggregateWindow(every: 5m, fn: mean, createEmpty: false)
+          |> keep(columns: ["_time", "_field", "_value"])
+          |> yield(name: "mean")
+        '''
+    
     def is_connected(self):
         """Check if InfluxDB is connected"""
         return self.client is not None
@@ -52,35 +160,29 @@ class SimpleInfluxDB:
         if not animal_counts:
             return True
         
-        timestamp = datetime.now(THAILAND_TZ)
-        timestamp_utc = timestamp.astimezone(timezone.utc)
-        
-        points = []
+        # Epoch nanoseconds are timezone-free; local time is only a display concern
+        ts_ns = time_ns()
         
         try:
+            # Line protocol is built directly instead of going through Point objects
+            tags = f"source={_escape_tag(source)},location={_escape_tag(location)}"
+            
             # Record the number of each type of animal.
-            for animal_type, count in animal_counts.items():
-                point = Point("animal_counts") \
-                    .tag("animal_type", animal_type) \
-                    .tag("source", source) \
-                    .tag("location", location) \
-                    .field("count", int(count)) \
-                    .field("detection_time", timestamp.isoformat()) \
-                    .time(timestamp)
-                points.append(point)
+            lines = [
+                f"animal_counts,animal_type={_escape_tag(animal_type)},{tags} "
+                f"count={int(count)}i {ts_ns}"
+                for animal_type, count in animal_counts.items()
+            ]
             
             # Record the total amount.
             total_count = sum(animal_counts.values())
-            total_point = Point("total_animals") \
-                .tag("source", source) \
-                .tag("location", location) \
-                .field("total_count", int(total_count)) \
-                .field("unique_types", len(animal_counts)) \
-                .time(timestamp)
-            points.append(total_point)
+            lines.append(
+                f"total_animals,{tags} "
+                f"total_count={int(total_count)}i,unique_types={len(animal_counts)}i {ts_ns}"
+            )
             
             # Write data to database
-            self.write_api.write(bucket=self.bucket, org=self.org, record=points)
+            self.write_api.write(bucket=self.bucket, org=self.org, record=lines)
             
             return True
             
@@ -93,26 +195,27 @@ class SimpleInfluxDB:
         if not self.is_connected() or not detections:
             return False
         
-        timestamp = datetime.now(timezone.utc)
-        points = []
+        ts_ns = time_ns()
         
         try:
-            for i, detection in enumerate(detections):
-                point = Point("detection_details") \
-                    .tag("animal_type", detection['class_name']) \
-                    .tag("source", source) \
-                    .tag("location", location) \
-                    .field("confidence", float(detection['confidence'])) \
-                    .field("coco_id", int(detection['coco_id'])) \
-                    .field("bbox_x1", int(detection['bbox'][0])) \
-                    .field("bbox_y1", int(detection['bbox'][1])) \
-                    .field("bbox_x2", int(detection['bbox'][2])) \
-                    .field("bbox_y2", int(detection['bbox'][3])) \
-                    .field("detection_id", i) \
-                    .time(timestamp)
-                points.append(point)
-            
-            self.write_api.write(bucket=self.bucket, org=self.org, record=points)
+            tags = f"source={_escape_tag(source)},location={_escape_tag(location)}"
+            
+            # Escape each class once
+            prefixes = {
+                name: f"detection_details,animal_type={_escape_tag(name)},{tags} "
+                for name in {d['class_name'] for d in detections}
+            }
+            
+            lines = [
+                f"{prefixes[d['class_name']]}"
+                f"confidence={float(d['confidence'])},coco_id={int(d['coco_id'])}i,"
+                f"bbox_x1={int(x1)}i,bbox_y1={int(y1)}i,bbox_x2={int(x2)}i,bbox_y2={int(y2)}i,"
+                f"detection_id={i}i {ts_ns}"
+                for i, d in enumerate(detections)
+                for x1, y1, x2, y2 in (d['bbox'],)
+            ]
+            
+            self.write_api.write(bucket=self.bucket, org=self.org, record=lines)
             return True
             
         except Exception as e:
@@ -124,14 +227,16 @@ class SimpleInfluxDB:
         if not self.is_connected():
             return False
         
+        # One clock read per call
+        ts_ns = time_ns()
+        
         try:
             point = Point("system_performance") \
                 .tag("source", source) \
                 .field("fps", float(fps)) \
                 .field("processing_time_ms", float(processing_time * 1000)) \
                 .field("frame_count", int(frame_count)) \
-                .field("timestamp", datetime.now(timezone.utc).isoformat()) \
-                .time(datetime.now(timezone.utc))
+                .time(ts_ns, write_precision=WritePrecision.NS)
             
             self.write_api.write(bucket=self.bucket, org=self.org, record=point)
             return True
@@ -147,25 +252,9 @@ class SimpleInfluxDB:
         
         try:
             if animal_type:
-                query = f'''
-                from(bucket: "{self.bucket}")
-                  |> range(start: -{hours}h)
-                  |> filter(fn: (r) => r["_measurement"] == "animal_counts")
-                  |> filter(fn: (r) => r["animal_type"] == "{animal_type}")
-                  |> filter(fn: (r) => r["_field"] == "count")
-                  |> aggregateWindow(every: 2m, fn: mean, createEmpty: false)
-                  |> yield(name: "mean")
-                '''
+                query = self._q_animal_type_history.format(hours=hours, animal_type=animal_type)
             else:
-                query = f'''
-                from(bucket: "{self.bucket}")
-                  |> range(start: -{hours}h)
-                  |> filter(fn: (r) => r["_measurement"] == "animal_counts")
-                  |> filter(fn: (r) => r["_field"] == "count")
-                  |> group(columns: ["animal_type"])
-                  |> aggregateWindow(every: 2m, fn: mean, createEmpty: false)
-                  |> yield(name: "mean")
-                '''
+                query = self._q_animal_history.format(hours=hours)
             
             result = self.query_api.query(org=self.org, query=query)
             return result
@@ -174,20 +263,88 @@ class SimpleInfluxDB:
             print(f"Query error: {e}")
             return None
     
+    def get_animal_history_df(self, hours=1):
+        """Pull animal count history as a DataFrame (_time, animal_type, _value)"""
+        if not self.is_connected():
+            return None
+        
+        try:
+            query = self._q_animal_history_df.format(hours=hours)
+            
+            df = self._to_frame(self.query_api.query_data_frame(query, org=self.org))
+            return df.reindex(columns=["_time", "animal_type", "_value"])
+            
+        except Exception as e:
+            print(f"Query error: {e}")
+            return None
+    
+    def get_animal_history_arrow(self, hours=1):
+        """Pull animal count history as a DataFrame, parsed by pyarrow's CSV reader
+        
+        Falls back to get_animal_history_df when pyarrow is not installed.
+        """
+        if pa is None:
+            return self.get_animal_history_df(hours)
+        
+        if not self.is_connected():
+            return None
+        
+        try:
+            query = self._q_animal_history_df.format(hours=hours)
+            
+            raw = self.query_api.query_raw(
+                query, org=self.org, dialect=Dialect(header=True, annotations=[])
+            ).data
+            
+            columns = ["_time", "animal_type", "_value"]
+            if not raw.strip():
+                return pd.DataFrame(columns=columns)
+            
+            table = pa_csv.read_csv(
+                BytesIO(raw),
+                convert_options=pa_csv.ConvertOptions(
+                    include_columns=columns,
+                    column_types={
+                        '_time': pa.timestamp('ns', tz='UTC'),
+                        'animal_type': pa.dictionary(pa.int32(), pa.string()),
+                        '_value': pa.float64()
+                    }
+                )
+            )
+            # dictionary -> category and timestamp -> datetime64 convert without copying strings
+            return table.to_pandas()
+            
+        except Exception as e:
+            print(f"Query error: {e}")
+            return None
+    
+    def get_animal_latest_counts(self, hours=1):
+        """Pull the highest count of each animal type, reduced on the server"""
+        if not self.is_connected():
+            return None
+        
+        try:
+            query = self._q_latest_counts.format(hours=hours)
+            
+            result = self.query_api.query(org=self.org, query=query)
+            
+            counts = {}
+            for table in result:
+                for record in table.records:
+                    counts[record.values.get('animal_type')] = int(record.get_value())
+            return counts
+            
+        except Exception as e:
+            print(f"Latest counts query error: {e}")
+            return None
+    
     def get_total_history(self, hours=1):
         """Pull the total number of animals history"""
         if not self.is_connected():
             return None
         
         try:
-            query = f'''
-            from(bucket: "{self.bucket}")
-              |> range(start: -{hours}h)
-              |> filter(fn: (r) => r["_measurement"] == "total_animals")
-              |> filter(fn: (r) => r["_field"] == "total_count")
-              |> aggregateWindow(every: 2m, fn: mean, createEmpty: false)
-              |> yield(name: "mean")
-            '''
+            query = self._q_total_history.format(hours=hours)
             
             result = self.query_api.query(org=self.org, query=query)
             return result
@@ -202,14 +359,7 @@ class SimpleInfluxDB:
             return None
         
         try:
-            query = f'''
-            from(bucket: "{self.bucket}")
-              |> range(start: -{hours}h)
-              |> filter(fn: (r) => r["_measurement"] == "detection_details")
-              |> group(columns: ["animal_type"])
-              |> count()
-              |> yield(name: "count")
-            '''
+            query = self._q_detection_summary.format(hours=hours)
             
             result = self.query_api.query(org=self.org, query=query)
             return result
@@ -224,14 +374,7 @@ class SimpleInfluxDB:
             return None
         
         try:
-            query = f'''
-            from(bucket: "{self.bucket}")
-              |> range(start: -{hours}h)
-              |> filter(fn: (r) => r["_measurement"] == "system_performance")
-              |> filter(fn: (r) => r["_field"] == "fps" or r["_field"] == "processing_time_ms")
-              |> aggregateWindow(every: 5m, fn: mean, createEmpty: false)
-              |> yield(name: "mean")
-            '''
+            query = self._q_performance.format(hours=hours)
             
             result = self.query_api.query(org=self.org, query=query)
             return result
@@ -240,6 +383,28 @@ class SimpleInfluxDB:
             print(f"Performance query error: {e}")
             return None
     
+    def get_performance_stats_df(self, hours=1):
+        """Pull system performance statistics as a DataFrame (_time, _field, _value)"""
+        if not self.is_connected():
+            return None
+        
+        try:
+            query = self._q_performance_df.format(hours=hours)
+            
+            df = self._to_frame(self.query_api.query_data_frame(query, org=self.org))
+            return df.reindex(columns=["_time", "_field", "_value"])
+            
+        except Exception as e:
+            print(f"Performance query error: {e}")
+            return None
+    
+    @staticmethod
+    def _to_frame(result):
+        """query_data_frame returns a list when tables have different schemas"""
+        if isinstance(result, list):
+            return pd.concat(result, ignore_index=True) if result else pd.DataFrame()
+        return result
+    
     def test_connection(self):
         """Test database connection"""
         if not self.is_connected():
@@ -251,7 +416,7 @@ class SimpleInfluxDB:
                 .field("test_value", 1) \
                 .time(datetime.now(timezone.utc))
             
-            self.write_api.write(bucket=self.bucket, org=self.org, record=test_point)
+            self.sync_write_api.write(bucket=self.bucket, org=self.org, record=test_point)
             print("Database connection test successful")
             return True
             
@@ -262,6 +427,8 @@ class SimpleInfluxDB:
     def close(self):
         """Close connection"""
         if self.client:
+            # Flush buffered points before closing the client
+            self.write_api.close()
             self.client.close()
             print(" InfluxDB connection closed")
 